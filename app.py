@@ -1,14 +1,21 @@
 # app.py
+import functools
 import os
 import time
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from zoneinfo import ZoneInfo
 from typing import Dict, Any, List, Tuple
 
-import requests
+import numpy as np
+import orjson
+import requests_cache
+from requests.adapters import HTTPAdapter, Retry
 import pandas as pd
 import streamlit as st
 
+import gex_kernel
+
 
 # -----------------------
 # Config
@@ -17,6 +24,9 @@ POLYGON_API_KEY = os.getenv("POLYGON_API_KEY", "").strip()
 BASE = "https://api.polygon.io"
 ET = ZoneInfo("America/New_York")
 
+# Below this row count pandas groupby overhead is negligible; above it the
+# numba kernel wins (full multi-expiration chains)
+NUMBA_MIN_ROWS = 2000
 
 # -----------------------
 # Helpers
@@ -25,18 +35,62 @@ def et_now() -> dt.datetime:
     return dt.datetime.now(tz=ET)
 
 
-def _polygon_get(url: str, params: Dict[str, Any] | None = None, timeout: int = 30) -> Dict[str, Any]:
+@st.cache_resource(show_spinner=False)
+def http_session() -> requests_cache.CachedSession:
+    """
+    Pooled session with a SQLite-backed HTTP cache: survives Streamlit reruns
+    AND container restarts (expired-day snapshots are immutable => cache
+    forever, per-request expire_after handles today's data). Keep-alive
+    amortizes the TCP+TLS handshake across paginated pages; cache_resource
+    keeps the warm connection pool across script reruns and hot-reloads.
+    """
+    s = requests_cache.CachedSession(
+        "polygon_cache",
+        backend="sqlite",
+        expire_after=requests_cache.NEVER_EXPIRE,
+        allowable_methods=("GET",),
+        # не пишем ключ в кеш: ни как query-параметр, ни как Bearer-заголовок
+        # (переопределение ignored_parameters сбрасывает дефолтную редакцию)
+        ignored_parameters=("apiKey", "Authorization"),
+    )
+    s.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504)),
+        ),
+    )
+    s.headers.update(
+        {
+            # Auth once per session instead of re-encoding apiKey into every URL
+            "Authorization": f"Bearer {POLYGON_API_KEY}",
+            "Accept": "application/json",
+            # zstd decodes faster than gzip at the same ratio; urllib3>=2
+            # handles it transparently when zstandard is installed
+            "Accept-Encoding": "zstd, gzip",
+        }
+    )
+    return s
+
+
+def _polygon_get(
+    url: str,
+    params: Dict[str, Any] | None = None,
+    timeout: int = 30,
+    expire_after: Any = None,
+    refresh: bool = False,
+) -> Dict[str, Any]:
     if not POLYGON_API_KEY:
         raise RuntimeError("POLYGON_API_KEY is empty. Add it in Railway Variables.")
-    params = dict(params or {})
-    params["apiKey"] = POLYGON_API_KEY
 
-    r = requests.get(url, params=params, timeout=timeout)
+    r = http_session().get(url, params=params or {}, timeout=timeout, expire_after=expire_after, refresh=refresh)
     if r.status_code in (401, 403):
         # Show Polygon error body (often contains 'NOT_AUTHORIZED' message)
         raise PermissionError(f"Polygon auth error ({r.status_code}): {r.text}")
     r.raise_for_status()
-    return r.json()
+    # orjson parses ~2-3x faster than requests' stdlib json on big snapshot pages
+    return orjson.loads(r.content)
 
 
 def fetch_snapshot_chain(
@@ -44,130 +98,276 @@ def fetch_snapshot_chain(
     expiration_date: str,
     ttl_sec: int,
     force_refresh: bool,
+    contract_type: str | None = None,  # "call" | "put" | None (both)
+    today_iso: str | None = None,  # pass the per-rerun snapshot; None = compute here
+    strike_gte: float | None = None,  # server-side strike bounds (e.g. spot +/- 15%)
+    strike_lte: float | None = None,
 ) -> List[Dict[str, Any]]:
     """
     Uses Polygon Snapshot Options Chain endpoint.
     NOTE: Snapshot is "current" and typically includes only active contracts.
+    Filtering (expiration_date, contract_type) is pushed server-side so we
+    never transfer contracts we'd just drop client-side.
     """
-    cache_key = f"snapshot_chain::{underlying}::{expiration_date}"
-
-    # Manual cache in session_state (survives reruns; not app restarts)
-    now_ts = time.time()
-    cache = st.session_state.get("cache", {})
-    entry = cache.get(cache_key)
-
-    if (not force_refresh) and entry:
-        age = now_ts - entry["ts"]
-        if age <= ttl_sec:
-            return entry["data"]
+    # Caching lives in the HTTP layer (requests-cache, keyed by URL+params):
+    # past expirations never change => keep forever; today's data gets the TTL.
+    if today_iso is None:
+        today_iso = et_now().date().isoformat()
+    if expiration_date < today_iso:
+        expire_after = requests_cache.NEVER_EXPIRE
+    elif ttl_sec > 0:
+        expire_after = ttl_sec
+    else:
+        expire_after = requests_cache.DO_NOT_CACHE
 
     # Pull snapshot chain (paginate if needed)
     url = f"{BASE}/v3/snapshot/options/{underlying}"
     params = {
         "expiration_date": expiration_date,
         "limit": 250,
+        # sort by expiration so we can stop paginating at the first overshoot
+        "sort": "expiration_date",
+        "order": "asc",
     }
+    if contract_type in ("call", "put"):
+        params["contract_type"] = contract_type
+    # Обрезаем дальние страйки ещё на сервере — меньше JSON по сети и в парсере
+    if strike_gte is not None:
+        params["strike_price.gte"] = float(strike_gte)
+    if strike_lte is not None:
+        params["strike_price.lte"] = float(strike_lte)
 
     data: List[Dict[str, Any]] = []
-    j = _polygon_get(url, params=params)
-
-    data.extend(j.get("results", []) or [])
-
-    # Pagination: Polygon sometimes returns next_url
-    next_url = j.get("next_url")
-    while next_url:
-        # next_url might be relative or full; normalize
-        if next_url.startswith("/"):
-            next_url_full = BASE + next_url
-        else:
-            next_url_full = next_url
-
-        # Ensure apiKey is present; easiest: call with _polygon_get which injects apiKey
-        j = _polygon_get(next_url_full, params={})
-        data.extend(j.get("results", []) or [])
-        next_url = j.get("next_url")
-
-    cache[cache_key] = {"ts": now_ts, "data": data}
-    st.session_state["cache"] = cache
+
+    # Pagination: the cursor in next_url is only known once the previous page
+    # has been decoded, so pages can't be fetched fully in parallel. But the
+    # cursor sits in the page envelope — a one-worker pool fires the next GET
+    # as soon as it's known, overlapping the network wait with this thread
+    # appending the current page's rows (all on the same warm TLS connection).
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(
+            _polygon_get, url, params, 30, expire_after, force_refresh
+        )
+        while True:
+            j = future.result()
+
+            next_url = j.get("next_url")
+            if next_url:
+                # next_url might be relative or full; normalize.
+                # Auth rides on the session's Bearer header.
+                next_url_full = BASE + next_url if next_url.startswith("/") else next_url
+                future = pool.submit(
+                    _polygon_get, next_url_full, {}, 30, expire_after, force_refresh
+                )
+
+            overshoot = False
+            for row in j.get("results", []) or []:
+                exp = (row.get("details") or {}).get("expiration_date")
+                if exp and exp > expiration_date:
+                    # Some plans mix expirations despite the filter; results
+                    # come back sorted asc, so nothing useful can follow.
+                    overshoot = True
+                    break
+                data.append(row)
+
+            if overshoot or not next_url:
+                break
+
     return data
 
 
-def compute_abs_gex_by_strike(snapshot_rows: List[Dict[str, Any]]) -> Tuple[pd.DataFrame, Dict[str, int]]:
+@functools.lru_cache(maxsize=8)
+def _market_status(minute_bucket: int) -> bool | None:
+    try:
+        j = _polygon_get(f"{BASE}/v1/marketstatus/now", expire_after=requests_cache.DO_NOT_CACHE)
+    except Exception:
+        return None
+    return j.get("market") == "open"
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def market_is_open_best_effort() -> bool | None:
+    """
+    Polygon /v1/marketstatus/now. Status changes at minute granularity, so a
+    60s TTL is safe and saves one RTT per widget interaction. Two layers:
+    st.cache_data (session-scoped) over a process-level lru_cache keyed by
+    minute bucket, so every caller in the process dedupes to one request/min.
+    Returns None when the status call fails (don't block the dashboard on it).
+    """
+    return _market_status(int(time.time() // 60))
+
+
+@functools.lru_cache(maxsize=64)
+def _probe_latest_expiration(underlying: str, requested: str, minute_bucket: int) -> str | None:
+    """
+    One query instead of walking dates back day by day: ask Polygon for the
+    newest contract with expiration_date <= requested and read its expiry.
+    Returns ISO date or None if nothing is available.
+    """
+    url = f"{BASE}/v3/snapshot/options/{underlying}"
+    params = {
+        "expiration_date.lte": requested,
+        "order": "desc",
+        "sort": "expiration_date",
+        "limit": 1,
+    }
+    try:
+        # короткий TTL вместо сессионного NEVER_EXPIRE: подсказка про
+        # «последнюю доступную экспирацию» меняется при листинге новых
+        # контрактов, навсегда кешировать её нельзя
+        j = _polygon_get(url, params=params, expire_after=60)
+    except Exception:
+        return None
+
+    results = j.get("results") or []
+    if not results:
+        return None
+    return (results[0].get("details") or {}).get("expiration_date")
+
+
+def probe_latest_expiration(underlying: str, requested: str) -> str | None:
+    return _probe_latest_expiration(underlying, requested, int(time.time() // 60))
+
+
+def compute_abs_gex_by_strike(
+    snapshot_rows: List[Dict[str, Any]],
+    strike_universe: np.ndarray | None = None,
+) -> Tuple[pd.DataFrame, Dict[str, int]]:
     """
     Variant 2:
     - CallGEX = gamma * open_interest
     - PutGEX  = -gamma * open_interest   (negative sign for puts)
     - AbsGEX per strike = abs(sum(CallGEX)) + abs(sum(PutGEX))
-    """
-    records = []
-    missing_gamma = 0
-    missing_oi = 0
-
-    for row in snapshot_rows:
-        details = row.get("details") or {}
-        greeks = row.get("greeks") or {}
-
-        strike = details.get("strike_price")
-        ctype = details.get("contract_type")  # "call" / "put"
-        gamma = greeks.get("gamma")
-        oi = row.get("open_interest")
-
-        if gamma is None:
-            missing_gamma += 1
-            continue
-        if oi is None:
-            missing_oi += 1
-            continue
-        if strike is None or ctype not in ("call", "put"):
-            continue
-
-        gex = float(gamma) * float(oi)
-        if ctype == "put":
-            gex = -gex
-
-        records.append(
-            {
-                "strike": float(strike),
-                "type": ctype,
-                "gamma": float(gamma),
-                "open_interest": float(oi),
-                "gex": float(gex),
-            }
-        )
 
-    df = pd.DataFrame(records)
+    strike_universe: sorted float32 strikes seen before for this underlying.
+    When it still covers the chain (the 0DTE grid is stable intraday), strikes
+    group as small categorical codes instead of hashed floats.
+    """
     stats = {
         "rows_total": len(snapshot_rows),
-        "rows_used": len(df),
-        "missing_gamma": missing_gamma,
-        "missing_oi": missing_oi,
+        "rows_used": 0,
+        "missing_gamma": 0,
+        "missing_oi": 0,
     }
 
-    if df.empty:
-        return df, stats
-
-    # Aggregate by strike: split calls/puts then absolute formula
-    agg = df.groupby(["strike", "type"], as_index=False)["gex"].sum()
+    if not snapshot_rows:
+        return pd.DataFrame(), stats
+
+    # Flatten nested dicts once; everything after this is C-level pandas/numpy,
+    # no Python-side per-row loop.
+    flat = pd.json_normalize(snapshot_rows, sep=".")
+    cols = ["details.strike_price", "details.contract_type", "greeks.gamma", "open_interest"]
+    for c in cols:
+        if c not in flat.columns:
+            flat[c] = np.nan
+    flat = flat[cols]
+
+    stats["missing_gamma"] = int(flat["greeks.gamma"].isna().sum())
+    stats["missing_oi"] = int(flat["open_interest"].isna().sum())
+
+    flat = flat.dropna()
+    flat = flat[flat["details.contract_type"].isin(("call", "put"))]
+    stats["rows_used"] = len(flat)
+
+    if flat.empty:
+        return pd.DataFrame(), stats
+
+    # Calls positive, puts negative — one vectorized sign flip.
+    # float32 + categorical 'type': halves memory bandwidth for the multiply
+    # and narrows the groupby hash keys.
+    sign = np.where(flat["details.contract_type"].values == "put", np.float32(-1.0), np.float32(1.0))
+    strikes_f32 = flat["details.strike_price"].astype("float32").values
+
+    # Reuse the cached strike grid when it still covers this chain
+    strike_col: Any = strikes_f32
+    if strike_universe is not None and np.isin(strikes_f32, strike_universe).all():
+        strike_col = pd.Categorical(strikes_f32, categories=strike_universe, ordered=True)
+
+    df = pd.DataFrame(
+        {
+            "strike": strike_col,
+            "type": pd.Categorical(flat["details.contract_type"].values, categories=("call", "put")),
+            "gex": sign * flat["greeks.gamma"].astype("float32").values * flat["open_interest"].astype("float32").values,
+        }
+    )
 
-    calls = agg[agg["type"] == "call"][["strike", "gex"]].rename(columns={"gex": "call_gex"})
-    puts = agg[agg["type"] == "put"][["strike", "gex"]].rename(columns={"gex": "put_gex"})  # already negative
+    # Aggregate by strike: one groupby, unstack call/put side by side
+    # (keys already align on the group index — no merge/hash-join needed)
+    if len(df) > NUMBA_MIN_ROWS:
+        # Big chains: single-pass jitted scatter-sum, no groupby hash tables
+        codes, strikes = pd.factorize(df["strike"].values, sort=True)
+        call_sum, put_sum = gex_kernel.gex_sums_by_strike(
+            codes.astype(np.int64),
+            df["type"].cat.codes.values == 1,  # categories are ("call", "put")
+            np.ascontiguousarray(df["gex"].values, dtype=np.float32),
+            len(strikes),
+        )
+        out = pd.DataFrame(
+            {"strike": np.asarray(strikes, dtype="float32"), "call_gex": call_sum, "put_gex": put_sum}
+        )
+    else:
+        # observed=True keeps unseen universe strikes out; reindex guarantees
+        # both call/put columns either way
+        grouped = (
+            df.groupby(["strike", "type"], observed=True)["gex"]
+            .sum()
+            .unstack(fill_value=0.0)
+            .reindex(columns=["call", "put"], fill_value=0.0)
+        )
 
-    out = pd.merge(calls, puts, on="strike", how="outer").fillna(0.0)
+        out = pd.DataFrame(
+            {
+                "strike": np.asarray(grouped.index, dtype="float32"),
+                "call_gex": grouped["call"].values,
+                "put_gex": grouped["put"].values,  # already negative
+            }
+        )
     out["abs_gex"] = out["call_gex"].abs() + out["put_gex"].abs()
-    out = out.sort_values("abs_gex", ascending=False).reset_index(drop=True)
+    # Не сортируем весь кадр по abs_gex: показываются только Top-N строк,
+    # их выбирает nlargest на стороне рендера за O(N)
     return out, stats
 
 
+# Кеш разведён на три слоя: fetch (сырые строки) -> aggregate (профиль по
+# страйкам) -> view (nlargest в рендере, не кешируется). Движение слайдера
+# Top-N не трогает первые два слоя; st.cache_data общий для всех сессий.
+@st.cache_data(max_entries=32, show_spinner=False)
+def _fetch_chain_cached(
+    underlying: str,
+    expiration_date: str,
+    ttl_sec: int,
+    time_bucket: float,
+    today_iso: str,
+    force_refresh: bool = False,
+) -> List[Dict[str, Any]]:
+    return fetch_snapshot_chain(
+        underlying=underlying,
+        expiration_date=expiration_date,
+        ttl_sec=ttl_sec,
+        force_refresh=force_refresh,
+        today_iso=today_iso,
+    )
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _profile_cached(
+    rows: List[Dict[str, Any]],
+    strike_universe: np.ndarray | None,
+) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    return compute_abs_gex_by_strike(rows, strike_universe=strike_universe)
+
+
+@st.cache_data(show_spinner=False)
 def demo_data() -> pd.DataFrame:
     # Simple synthetic example to verify computation & chart
     # (call_gex positive, put_gex negative, abs = abs(call) + abs(put))
-    data = [
-        {"strike": 470, "call_gex": 1200.0, "put_gex": -800.0},
-        {"strike": 475, "call_gex": 300.0, "put_gex": -2200.0},
-        {"strike": 480, "call_gex": 900.0, "put_gex": -900.0},
-        {"strike": 485, "call_gex": 1500.0, "put_gex": -200.0},
-    ]
-    df = pd.DataFrame(data)
+    df = pd.DataFrame(
+        {
+            "strike": [470, 475, 480, 485],
+            "call_gex": [1200.0, 300.0, 900.0, 1500.0],
+            "put_gex": [-800.0, -2200.0, -900.0, -200.0],
+        }
+    )
     df["abs_gex"] = df["call_gex"].abs() + df["put_gex"].abs()
     return df.sort_values("abs_gex", ascending=False).reset_index(drop=True)
 
@@ -179,16 +379,18 @@ st.set_page_config(page_title="0DTE Absolute GEX by Strike", layout="wide")
 
 st.title("0DTE Absolute GEX by Strike (Abs(CallGEX) + Abs(PutGEX))")
 
+# One clock snapshot per rerun — captions, defaults and cache logic below all
+# see the same instant instead of re-paying the tz conversion per call site
+NOW_ET = et_now()
+TODAY_ET = NOW_ET.date()
+
 # Session defaults
 if "asof" not in st.session_state:
-    st.session_state["asof"] = et_now().date()
+    st.session_state["asof"] = TODAY_ET
 
 if "force_refresh" not in st.session_state:
     st.session_state["force_refresh"] = False
 
-if "cache" not in st.session_state:
-    st.session_state["cache"] = {}
-
 with st.sidebar:
     st.header("Inputs")
 
@@ -209,7 +411,12 @@ with st.sidebar:
         clear_cache = st.button("🧹 Clear cache", use_container_width=True)
 
     if clear_cache:
-        st.session_state["cache"] = {}
+        # чистим оба слоя: HTTP-кеш на диске и st.cache_data поверх него,
+        # иначе fetch/profile продолжат отдавать мемоизированный результат
+        # до смены time_bucket
+        http_session().cache.clear()
+        _fetch_chain_cached.clear()
+        _profile_cached.clear()
         st.toast("Cache cleared")
 
     # Force refresh triggers a new fetch on this run
@@ -217,8 +424,9 @@ with st.sidebar:
 
 
 # Status line
-now = et_now()
-st.caption(f"ET time now: {now.strftime('%Y-%m-%d %H:%M:%S')}")
+market_open = market_is_open_best_effort() if not demo_mode else None
+status_suffix = "" if market_open is None else (" | рынок открыт" if market_open else " | рынок закрыт")
+st.caption(f"ET time now: {NOW_ET.strftime('%Y-%m-%d %H:%M:%S')}{status_suffix}")
 
 # IMPORTANT NOTE about Snapshot vs Historical
 st.info(
@@ -237,13 +445,38 @@ if demo_mode:
     stats = {"rows_total": 0, "rows_used": len(out), "missing_gamma": 0, "missing_oi": 0}
 else:
     try:
-        rows = fetch_snapshot_chain(
-            underlying=underlying,
-            expiration_date=expiration_date,
-            ttl_sec=int(ttl_sec),
-            force_refresh=bool(st.session_state["force_refresh"]),
+        # Market closed => today's chain is frozen; stretch the TTL so reruns
+        # are served straight from the disk cache without touching Polygon.
+        # (Explicit "Refresh now" still bypasses the cache.)
+        effective_ttl = int(ttl_sec)
+        if market_open is False and expiration_date == TODAY_ET.isoformat():
+            effective_ttl = max(effective_ttl, 1800)
+
+        force = bool(st.session_state["force_refresh"])
+        if force:
+            _fetch_chain_cached.clear()
+            _profile_cached.clear()
+
+        # TTL через бакет в ключе; ttl=0 => бакет уникален на каждый ран
+        time_bucket = time.time() if effective_ttl <= 0 else float(int(time.time() // effective_ttl))
+        rows = _fetch_chain_cached(
+            underlying,
+            expiration_date,
+            effective_ttl,
+            time_bucket,
+            TODAY_ET.isoformat(),
+            force,
         )
-        out, stats = compute_abs_gex_by_strike(rows)
+        universe_map = st.session_state.setdefault("strike_universe", {})
+        out, stats = _profile_cached(rows, universe_map.get(underlying))
+
+        # Remember the strike grid so the next rerun groups on categorical codes
+        if not out.empty:
+            seen = universe_map.get(underlying)
+            observed = out["strike"].values
+            if seen is None or not np.isin(observed, seen).all():
+                merged = observed if seen is None else np.union1d(seen, observed)
+                universe_map[underlying] = np.sort(merged).astype("float32")
     except Exception as e:
         st.error(f"Data fetch failed: {e}")
         st.stop()
@@ -259,11 +492,18 @@ if out is None or out.empty:
         "Для проверки логики включи **Demo mode** в сайдбаре."
     )
 
+    if not demo_mode:
+        latest = probe_latest_expiration(underlying, expiration_date)
+        if latest and latest != expiration_date:
+            st.caption(f"Ближайшая доступная экспирация ≤ {expiration_date}: **{latest}**")
+
     with st.expander("Debug details"):
         st.write(stats)
 else:
-    show = out.head(int(top_n)).copy()
-    show = show.sort_values("strike")  # nicer left-to-right chart
+    # Top-N via heap-based partial sort (O(N)), then only the k-row slice
+    # gets re-sorted by strike for the chart
+    top = out.nlargest(int(top_n), "abs_gex")
+    show = top.sort_values("strike")  # nicer left-to-right chart
 
     left, right = st.columns([2, 1], gap="large")
 
@@ -275,7 +515,7 @@ else:
     with right:
         st.subheader("Top strikes")
         # Display table sorted by abs_gex desc
-        st.dataframe(out.head(int(top_n)), use_container_width=True, hide_index=True)
+        st.dataframe(top, use_container_width=True, hide_index=True)
 
     with st.expander("Debug details"):
         st.write(stats)
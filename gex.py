@@ -1,10 +1,19 @@
+import hashlib
 import math
+import struct
 import numpy as np
 import pandas as pd
-from scipy.stats import norm
+
+from gex_kernel import gex_sums_by_strike
 
 CONTRACT_MULTIPLIER = 100
 
+# ниже этого размера bincount и так упирается в память, JIT не окупается
+NUMBA_MIN_ROWS = 2000
+
+_INV_SQRT_2PI = 1.0 / math.sqrt(2.0 * math.pi)
+
+
 def bs_gamma(S: float, K: float, T: float, r: float, sigma: float) -> float:
     """
     Black-Scholes gamma for equity options.
@@ -14,7 +23,56 @@ def bs_gamma(S: float, K: float, T: float, r: float, sigma: float) -> float:
     if S <= 0 or K <= 0 or T <= 0 or sigma <= 0:
         return np.nan
     d1 = (math.log(S / K) + (r + 0.5 * sigma**2) * T) / (sigma * math.sqrt(T))
-    return norm.pdf(d1) / (S * sigma * math.sqrt(T))
+    # нормальный PDF руками — без диспатча scipy на каждый скалярный вызов
+    pdf = math.exp(-0.5 * d1 * d1) * _INV_SQRT_2PI
+    return pdf / (S * sigma * math.sqrt(T))
+
+
+def bs_gamma_vec(
+    S: float | np.ndarray, K: np.ndarray, T: np.ndarray, r: float, sigma: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized bs_gamma over whole arrays of strikes/TTE/IV.
+    Normal PDF inlined (exp(-d1^2/2)/sqrt(2*pi)) — no scipy dispatch,
+    one numpy pass instead of a Python loop per row.
+    S may be a scalar spot or a per-row array — so chains for several
+    underlyings/expirations can be concatenated and priced in one call
+    instead of looping per chain.
+    Invalid rows (K/T/sigma <= 0) come back as NaN.
+    """
+    S = np.asarray(S, dtype=np.float64)
+    K = np.asarray(K, dtype=np.float64)
+    T = np.asarray(T, dtype=np.float64)
+    sigma = np.asarray(sigma, dtype=np.float64)
+
+    valid = (S > 0) & (K > 0) & (T > 0) & (sigma > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sqrt_t = np.sqrt(T)
+        d1 = (np.log(S / K) + (r + 0.5 * sigma * sigma) * T) / (sigma * sqrt_t)
+        pdf = np.exp(-0.5 * d1 * d1) * _INV_SQRT_2PI
+        gamma = pdf / (S * sigma * sqrt_t)
+    return np.where(valid, gamma, np.nan)
+
+# Мемоизация гаммы между реранами Streamlit: входные векторы не меняются
+# минутами, а top_n/переключатели вызывают пересчёт с теми же данными
+_GAMMA_CACHE: dict[bytes, np.ndarray] = {}
+_GAMMA_CACHE_MAX = 32
+
+
+def _bs_gamma_cached(spot: float, strikes: np.ndarray, ttes: np.ndarray, ivs: np.ndarray, r: float) -> np.ndarray:
+    key = hashlib.blake2b(
+        np.ascontiguousarray(np.stack([strikes, ttes, ivs])).tobytes() + struct.pack("dd", spot, r),
+        digest_size=16,
+    ).digest()
+    gamma = _GAMMA_CACHE.get(key)
+    if gamma is None:
+        # float32 достаточно для бар-чарта, а полосы памяти в агрегации — вдвое меньше
+        gamma = bs_gamma_vec(spot, strikes, ttes, r, ivs).astype(np.float32)
+        if len(_GAMMA_CACHE) >= _GAMMA_CACHE_MAX:
+            _GAMMA_CACHE.pop(next(iter(_GAMMA_CACHE)))  # простой FIFO
+        _GAMMA_CACHE[key] = gamma
+    return gamma
+
 
 def compute_abs_gex_by_strike(df: pd.DataFrame, spot: float, r: float = 0.05) -> pd.DataFrame:
     """
@@ -28,27 +86,71 @@ def compute_abs_gex_by_strike(df: pd.DataFrame, spot: float, r: float = 0.05) ->
     Returns aggregated by strike with:
       CallGEX, PutGEX, AbsGEX (variant 2), NetGEX, plus helpers.
     """
-    work = df.copy()
+    # Нулевой/пустой OI не даёт вклада в GEX — отбрасываем такие строки
+    # до расчёта гаммы (на 0DTE это обычно большинство страйков)
+    oi = pd.to_numeric(df["open_interest"], errors="coerce").fillna(0.0).astype(np.float32)
+    active = oi.to_numpy() > 0
+    if not active.all():
+        df = df.loc[active]
+        oi = oi.loc[active]
 
-    # gamma: use provided if exists, else compute from IV
-    if "gamma" not in work.columns or work["gamma"].isna().all():
-        work["gamma"] = work.apply(
-            lambda row: bs_gamma(spot, row["strike"], row["tte_years"], r, row.get("iv", np.nan)),
-            axis=1
+    # gamma: use provided if exists, else compute from IV (vectorized, not .apply)
+    if "gamma" not in df.columns or df["gamma"].isna().all():
+        if "iv" in df.columns:
+            iv = pd.to_numeric(df["iv"], errors="coerce").to_numpy()
+        else:
+            iv = np.full(len(df), np.nan)
+        gamma = pd.Series(
+            _bs_gamma_cached(
+                spot,
+                pd.to_numeric(df["strike"], errors="coerce").to_numpy(),
+                pd.to_numeric(df["tte_years"], errors="coerce").to_numpy(),
+                iv,
+                r,
+            ),
+            index=df.index,
         )
+    else:
+        gamma = pd.to_numeric(df["gamma"], errors="coerce").astype(np.float32)
 
-    work["open_interest"] = pd.to_numeric(work["open_interest"], errors="coerce").fillna(0.0)
-    work["gamma"] = pd.to_numeric(work["gamma"], errors="coerce")
+    # GEX per contract line: gamma * OI * 100.
+    # NaN gamma ведёт себя как в groupby.sum(skipna) — вклад ноль.
+    gex = np.nan_to_num(gamma.to_numpy() * oi.to_numpy() * CONTRACT_MULTIPLIER)
 
-    # GEX per contract line: gamma * OI * 100
-    work["gex"] = work["gamma"] * work["open_interest"] * CONTRACT_MULTIPLIER
+    # Агрегация через factorize + bincount: чистые C-циклы, без groupby
+    # hash-таблиц и без промежуточного working-frame
+    type_arr = np.asarray(df["type"])
+    is_call = type_arr == "call"
+    keep = is_call | (type_arr == "put")
+    strike_arr = pd.to_numeric(df["strike"], errors="coerce").to_numpy()
+    keep &= ~np.isnan(strike_arr)
 
-    calls = work[work["type"] == "call"].groupby("strike")["gex"].sum().rename("CallGEX")
-    puts  = work[work["type"] == "put"].groupby("strike")["gex"].sum().rename("PutGEX")
+    codes, uniques = pd.factorize(strike_arr[keep], sort=True)
+    gex_k = gex[keep]
+    if gex_k.size > NUMBA_MIN_ROWS:
+        # большие цепочки (все экспирации): один JIT-проход без двух
+        # bincount и без временных weight-массивов
+        call_gex, put_gex = gex_sums_by_strike(
+            codes.astype(np.int64),
+            ~is_call[keep],
+            gex_k.astype(np.float32),
+            len(uniques),
+        )
+    else:
+        call_w = np.where(is_call[keep], gex_k, 0.0)
+        call_gex = np.bincount(codes, weights=call_w, minlength=len(uniques))
+        put_gex = np.bincount(codes, weights=gex_k - call_w, minlength=len(uniques))
 
-    out = pd.concat([calls, puts], axis=1).fillna(0.0).reset_index()
+    out = pd.DataFrame(
+        {
+            "strike": uniques,
+            "CallGEX": np.asarray(call_gex, dtype=np.float32),
+            "PutGEX": np.asarray(put_gex, dtype=np.float32),
+        }
+    )
 
     out["AbsGEX"] = out["CallGEX"].abs() + out["PutGEX"].abs()          # ✅ вариант 2
     out["NetGEX"] = out["CallGEX"] - out["PutGEX"]                      # полезно для направления
-    out = out.sort_values("strike").reset_index(drop=True)
+    # factorize(sort=True) уже отдал uniques по возрастанию strike —
+    # повторный sort_values был бы лишним O(N log N) плюс две переиндексации
     return out
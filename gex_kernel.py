@@ -0,0 +1,25 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def gex_sums_by_strike(strike_idx, is_put, gex, n_strikes):
+    """
+    One-pass scatter-sum of signed per-contract GEX into call/put buckets.
+
+    strike_idx: int64 codes from pd.factorize(strike, sort=True)
+    is_put:     bool array, one flag per contract
+    gex:        float32 signed gex (puts already negative)
+    n_strikes:  number of unique strikes
+
+    Serial on purpose: a prange version would race on the scatter writes,
+    and a single 0DTE chain is far too small to amortize a parallel reduction.
+    """
+    call_sum = np.zeros(n_strikes, dtype=np.float32)
+    put_sum = np.zeros(n_strikes, dtype=np.float32)
+    for i in range(strike_idx.shape[0]):
+        if is_put[i]:
+            put_sum[strike_idx[i]] += gex[i]
+        else:
+            call_sum[strike_idx[i]] += gex[i]
+    return call_sum, put_sum
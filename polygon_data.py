@@ -1,12 +1,48 @@
 import os
 import time
-import requests
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+from requests.adapters import HTTPAdapter, Retry
+from requests_cache import CachedSession
+import numpy as np
 import pandas as pd
 
+from gex_kernel import gex_sums_by_strike
+
 
 POLYGON_API_KEY = os.getenv("POLYGON_API_KEY", "").strip()
 BASE = "https://api.polygon.io"
 
+# ниже этого размера bincount и так упирается в память, JIT не окупается
+NUMBA_MIN_ROWS = 2000
+
+_CT_OK = frozenset(("call", "put"))
+
+# Дашборды дёргают один и тот же (underlying, as_of) каждые несколько секунд —
+# короткий TTL-кэш в памяти снимает повторные TLS+parse+агрегацию целиком
+POLYGON_CACHE_TTL = int(os.getenv("POLYGON_CACHE_TTL", "30"))
+
+# Общая сессия: keep-alive переиспользует TCP+TLS между страницами/вызовами
+_SESSION = CachedSession(
+    "polygon_cache",
+    backend="memory",
+    expire_after=POLYGON_CACHE_TTL,
+    allowable_methods=("GET",),
+)
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504)),
+    ),
+)
+# zstd распаковывается быстрее gzip при том же ratio; urllib3>=2 декодирует
+# его прозрачно, когда установлен zstandard, gzip остаётся фолбэком
+_SESSION.headers["Accept-Encoding"] = "zstd, gzip"
+
 
 class PolygonAuthError(Exception):
     pass
@@ -16,36 +52,132 @@ class PolygonRequestError(Exception):
     pass
 
 
-def _get_json(url: str, params: dict | None = None, timeout: int = 30) -> dict:
+def _get_bytes(url: str, params: dict | None = None, timeout: int = 30) -> bytes:
     if not POLYGON_API_KEY:
         raise PolygonAuthError("POLYGON_API_KEY is empty. Add it to Railway Variables.")
 
-    params = dict(params or {})
-    params["apiKey"] = POLYGON_API_KEY
+    # Авторизация заголовком — не пересобираем query string с apiKey на каждый вызов
+    headers = {"Authorization": f"Bearer {POLYGON_API_KEY}"}
 
-    r = requests.get(url, params=params, timeout=timeout)
+    r = _SESSION.get(url, params=params or {}, headers=headers, timeout=timeout)
 
     # Явно обрабатываем ошибки доступа/плана
     if r.status_code in (401, 403):
         try:
-            payload = r.json()
-        except Exception:
+            payload = orjson.loads(r.content)
+        except orjson.JSONDecodeError:
             payload = {"message": r.text}
         raise PolygonAuthError(f"Polygon auth error ({r.status_code}): {payload}")
 
     if r.status_code >= 400:
         raise PolygonRequestError(f"Polygon request failed ({r.status_code}): {r.text}")
 
-    return r.json()
+    return r.content
 
 
-def fetch_0dte_abs_gex_by_strike(
+def _get_json(url: str, params: dict | None = None, timeout: int = 30) -> dict:
+    # orjson заметно быстрее stdlib json на больших snapshot-страницах
+    return orjson.loads(_get_bytes(url, params, timeout))
+
+
+def _fetch_side(
+    underlying: str,
+    as_of: str,
+    contract_type: str,
+    limit: int,
+    sleep_s: float,
+    max_pages: int,
+    strike_min: float | None,
+    strike_max: float | None,
+) -> tuple[array, array, array, array]:
+    """Paginate one side of the chain (calls or puts) into typed buffers."""
+    url = f"{BASE}/v3/snapshot/options/{underlying}"
+    params = {
+        "expiration_date": as_of,   # 0DTE
+        "limit": int(limit),
+        "contract_type": contract_type,
+    }
+    # Предикат по страйку уходит на сервер: дашборду обычно нужен диапазон
+    # вокруг спота, и фильтр на стороне API срезает и байты, и страницы
+    if strike_min is not None:
+        params["strike_price.gte"] = float(strike_min)
+    if strike_max is not None:
+        params["strike_price.lte"] = float(strike_max)
+
+    # Типизированные колоночные буферы (SoA): 4 байта на значение вместо
+    # боксированных PyFloat в списках, конвертация в numpy без копии.
+    # float32 хватает с запасом (greeks у Polygon ~4 значащих цифры),
+    # а полоса памяти в агрегации — вдвое меньше
+    strikes = array("f")
+    type_flags = array("b")  # 0 = call, 1 = put
+    gammas = array("f")
+    ois = array("f")
+    pages = 0
+
+    # Горячий цикл бежит по разу на контракт: предзабинденные append'ы и
+    # frozenset сторон снимают повторный lookup атрибутов на каждой строке
+    append_strike = strikes.append
+    append_type = type_flags.append
+    append_gamma = gammas.append
+    append_oi = ois.append
+    ct_ok = _CT_OK
+
+    # Курсор пагинации известен только из конверта предыдущей страницы, зато
+    # его видно до разбора строк: однопоточный пул качает только байты
+    # следующей страницы, а декод orjson и раскладка по буферам идут в этом
+    # потоке — parse(N) перекрывается с GET(N+1), а не стоит за ним в очереди
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(_get_bytes, url, params)
+        while True:
+            data = orjson.loads(future.result())
+            pages += 1
+
+            next_url = data.get("next_url")
+            if next_url and pages < max_pages:
+                # авторизация — заголовком в _get_bytes; max_pages — страховка
+                # от бесконечной пагинации (0DTE обычно 1-2 страницы)
+                if sleep_s and sleep_s > 0:
+                    time.sleep(sleep_s)
+                future = pool.submit(_get_bytes, next_url, {})
+            else:
+                next_url = None
+
+            for item in data.get("results") or []:
+                details = item.get("details") or {}
+                greeks = item.get("greeks") or {}
+
+                strike = details.get("strike_price")
+                ctype = details.get("contract_type")  # "call" / "put"
+                gamma = greeks.get("gamma")
+                oi = item.get("open_interest")
+
+                if strike is None or ctype not in ct_ok:
+                    continue
+                if gamma is None or oi is None:
+                    # у некоторых контрактов greeks могут быть пустыми — пропускаем
+                    continue
+
+                append_strike(float(strike))
+                append_type(0 if ctype == "call" else 1)
+                append_gamma(float(gamma))
+                append_oi(float(oi))
+
+            if not next_url:
+                break
+
+    return strikes, type_flags, gammas, ois
+
+
+def fetch_0dte_abs_gex_arrays(
     underlying: str,
     as_of: str,
     contract_type: str | None = None,  # "call" | "put" | None
-    limit: int = 250,
+    limit: int = 250,  # максимум v3 snapshot (1000 — лимит reference, тут вернёт 400)
     sleep_s: float = 0.0,
-) -> pd.DataFrame:
+    max_pages: int = 20,
+    strike_min: float | None = None,
+    strike_max: float | None = None,
+) -> dict[str, np.ndarray]:
     """
     Pull 0DTE option chain snapshot for `underlying` and expiration_date=`as_of`,
     compute per-strike:
@@ -53,87 +185,100 @@ def fetch_0dte_abs_gex_by_strike(
       PutGEX  = sum(gamma * open_interest) for puts  (kept negative sign for convenience)
       AbsGEX  = abs(CallGEX) + abs(PutGEX_signed)
 
+    Returns plain numpy arrays keyed strike/call_gex/put_gex/abs_gex —
+    на маленьких чейнах сборка DataFrame (BlockManager, индексы, Series)
+    стоит дороже самой агрегации, поэтому это основной путь, а DataFrame
+    строится только в обёртке для тех, кому он нужен.
+
     No spot used. No multiplier applied (если захочешь *100 — скажешь).
     """
     underlying = underlying.upper().strip()
 
-    url = f"{BASE}/v3/snapshot/options/{underlying}"
-    params = {
-        "expiration_date": as_of,   # 0DTE
-        "limit": int(limit),
-    }
     if contract_type in ("call", "put"):
-        params["contract_type"] = contract_type
-
-    rows: list[dict] = []
-    next_url: str | None = None
-
-    while True:
-        if next_url:
-            data = _get_json(next_url, params={})  # next_url уже содержит apiKey? нет -> мы добавим в _get_json
-        else:
-            data = _get_json(url, params=params)
-
-        results = data.get("results") or []
-        for item in results:
-            details = item.get("details") or {}
-            greeks = item.get("greeks") or {}
-
-            strike = details.get("strike_price")
-            ctype = details.get("contract_type")  # "call" / "put"
-            gamma = greeks.get("gamma")
-            oi = item.get("open_interest")
-
-            if strike is None or ctype not in ("call", "put"):
-                continue
-            if gamma is None or oi is None:
-                # у некоторых контрактов greeks могут быть пустыми — пропускаем
-                continue
-
-            rows.append(
-                {
-                    "strike": float(strike),
-                    "type": ctype,
-                    "gamma": float(gamma),
-                    "open_interest": float(oi),
-                }
+        sides = [
+            _fetch_side(
+                underlying, as_of, contract_type, limit, sleep_s, max_pages, strike_min, strike_max
             )
+        ]
+    else:
+        # Фильтруем по стороне всегда на сервере: две короткие цепочки
+        # качаются параллельно вместо одной длинной — примерно вдвое
+        # меньше RTT до полного чейна
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [
+                pool.submit(
+                    _fetch_side, underlying, as_of, ct, limit, sleep_s, max_pages, strike_min, strike_max
+                )
+                for ct in ("call", "put")
+            ]
+            sides = [f.result() for f in futures]
+
+    strikes = array("f")
+    type_flags = array("b")
+    gammas = array("f")
+    ois = array("f")
+    for s, t, g, o in sides:
+        strikes.extend(s)
+        type_flags.extend(t)
+        gammas.extend(g)
+        ois.extend(o)
+
+    if not strikes:
+        return {
+            "strike": np.empty(0, dtype=np.float32),
+            "call_gex": np.empty(0, dtype=np.float32),
+            "put_gex": np.empty(0, dtype=np.float32),
+            "abs_gex": np.empty(0, dtype=np.float32),
+        }
+
+    strike_arr = np.frombuffer(strikes, dtype=np.float32)
+    gamma_arr = np.frombuffer(gammas, dtype=np.float32)
+    oi_arr = np.frombuffer(ois, dtype=np.float32)
+    is_call = np.frombuffer(type_flags, dtype=np.int8) == 0
+
+    # calls positive, puts negative (удобно для Net, но Abs считаем отдельно);
+    # знаки как float32-литералы, чтобы np.where не поднимал всё в float64
+    gex = np.where(is_call, np.float32(1.0), np.float32(-1.0)) * gamma_arr * oi_arr
+
+    # Группировка по страйку через unique + bincount: один C-проход,
+    # без промежуточного DataFrame и без pivot_table
+    uniq, inv = np.unique(strike_arr, return_inverse=True)
+    if gex.size > NUMBA_MIN_ROWS:
+        # большие цепочки: один JIT-проход scatter-sum вместо двух bincount
+        # и двух временных weight-массивов (тот же кернел, что и в gex.py)
+        call_gex, put_gex = gex_sums_by_strike(
+            inv.astype(np.int64),
+            ~is_call,
+            gex,
+            len(uniq),
+        )
+    else:
+        # bincount внутри считает в float64 — даункастим обратно на выходе
+        call_gex = np.bincount(inv, weights=np.where(is_call, gex, 0.0), minlength=len(uniq)).astype(np.float32)
+        put_gex = np.bincount(inv, weights=np.where(is_call, 0.0, gex), minlength=len(uniq)).astype(np.float32)
+
+    # uniq уже отсортирован по возрастанию strike
+    return {
+        "strike": uniq,
+        "call_gex": call_gex,
+        "put_gex": put_gex,
+        "abs_gex": np.abs(call_gex) + np.abs(put_gex),
+    }
 
-        next_url = data.get("next_url")
-        if not next_url:
-            break
-
-        # Massive/Polygon next_url обычно без apiKey — добавим его
-        if "apiKey=" not in next_url and POLYGON_API_KEY:
-            sep = "&" if "?" in next_url else "?"
-            next_url = f"{next_url}{sep}apiKey={POLYGON_API_KEY}"
-
-        if sleep_s and sleep_s > 0:
-            time.sleep(sleep_s)
-
-    if not rows:
-        return pd.DataFrame(columns=["strike", "call_gex", "put_gex", "abs_gex"])
-
-    df = pd.DataFrame(rows)
-    df["gex"] = df["gamma"] * df["open_interest"]
-
-    # calls positive, puts negative (удобно для Net, но Abs считаем отдельно)
-    df.loc[df["type"] == "put", "gex"] *= -1.0
-
-    # агрегируем по strike
-    pivot = df.pivot_table(index="strike", columns="type", values="gex", aggfunc="sum").fillna(0.0)
-    # гарантируем колонки
-    if "call" not in pivot.columns:
-        pivot["call"] = 0.0
-    if "put" not in pivot.columns:
-        pivot["put"] = 0.0
 
-    out = (
-        pivot.rename(columns={"call": "call_gex", "put": "put_gex"})
-        .reset_index()
-        .sort_values("strike")
-        .reset_index(drop=True)
+def fetch_0dte_abs_gex_by_strike(
+    underlying: str,
+    as_of: str,
+    contract_type: str | None = None,  # "call" | "put" | None
+    limit: int = 250,
+    sleep_s: float = 0.0,
+    max_pages: int = 20,
+    strike_min: float | None = None,
+    strike_max: float | None = None,
+) -> pd.DataFrame:
+    """Обёртка над fetch_0dte_abs_gex_arrays для потребителей, ждущих DataFrame."""
+    return pd.DataFrame(
+        fetch_0dte_abs_gex_arrays(
+            underlying, as_of, contract_type, limit, sleep_s, max_pages, strike_min, strike_max
+        )
     )
-
-    out["abs_gex"] = out["call_gex"].abs() + out["put_gex"].abs()
-    return out